@@ -34,15 +34,37 @@ SINONIMOS = {
     "gratuito": "gratuitos"
 }
 
+# Termos de fallback em ordem de prioridade: primeiro sinônimos, depois chaves originais
+TERMOS_FALLBACK = [(termo, chave) for termo, chave in SINONIMOS.items()] + \
+    [(palavra_chave.lower(), palavra_chave) for palavra_chave in RESPOSTAS]
+
+
+def _build_automaton():
+    """Autômato Aho-Corasick com todos os termos (casamento em uma única passada)."""
+    try:
+        import ahocorasick
+    except ImportError:
+        return None
+    automaton = ahocorasick.Automaton()
+    for prioridade, (termo, chave) in enumerate(TERMOS_FALLBACK):
+        # mantém a primeira ocorrência de um termo repetido (maior prioridade)
+        if termo not in automaton:
+            automaton.add_word(termo, (prioridade, chave))
+    automaton.make_automaton()
+    return automaton
+
+
+AUTOMATO_FALLBACK = _build_automaton()
+
+
 def match_fallback(query_lower: str):
-    # casa primeiro por sinônimos
-    for termo, chave in SINONIMOS.items():
+    if AUTOMATO_FALLBACK is not None:
+        melhor = min((valor for _, valor in AUTOMATO_FALLBACK.iter(query_lower)), default=None)
+        return RESPOSTAS.get(melhor[1]) if melhor else None
+    # sem pyahocorasick: casa primeiro por sinônimos, depois chaves originais
+    for termo, chave in TERMOS_FALLBACK:
         if termo in query_lower:
             return RESPOSTAS.get(chave)
-    # depois tenta chaves originais
-    for palavra_chave, texto in RESPOSTAS.items():
-        if palavra_chave.lower() in query_lower:
-            return texto
     return None
 
 
@@ -52,6 +74,7 @@ def initialize_rag():
     try:
         # Configuração via variáveis de ambiente
         embeddings_model = os.environ.get('EMBEDDINGS_MODEL')
+        embeddings_backend = os.environ.get('EMBEDDINGS_BACKEND', 'sentence-transformers').lower()
         qa_model = os.environ.get('QA_MODEL')
         top_k = int(os.environ.get('TOP_K', '5'))
         chunk_chars = int(os.environ.get('CHUNK_CHARS', '700'))
@@ -60,6 +83,11 @@ def initialize_rag():
         reranker_model = os.environ.get('RERANKER_MODEL')
         pre_k = int(os.environ.get('RERANK_PRE_K', str(max(top_k * 3, top_k))))
         cache_dir = os.environ.get('CACHE_DIR', 'cache')
+        microbatch_wait_ms = float(os.environ.get('MICROBATCH_WAIT_MS', '10'))
+        quantize = os.environ.get('QUANTIZE_EMBEDDINGS', 'False').lower() == 'true'
+        precision = os.environ.get('MODEL_PRECISION', 'fp32').lower()
+        use_onnx = os.environ.get('USE_ONNX', 'False').lower() == 'true'
+        onnx_provider = os.environ.get('ONNX_PROVIDER', 'CPUExecutionProvider')
 
         # Cria instância e roda inicialização
         rag_engine = RAGEngine(
@@ -71,7 +99,13 @@ def initialize_rag():
             batch_size=batch_size,
             reranker_model_name=reranker_model,
             pre_k=pre_k,
-            cache_dir=cache_dir
+            cache_dir=cache_dir,
+            quantize=quantize,
+            precision=precision,
+            use_onnx=use_onnx,
+            onnx_provider=onnx_provider,
+            embeddings_backend=embeddings_backend,
+            microbatch_wait_ms=microbatch_wait_ms
         )
         rag_engine.initialize()
         print("Motor RAG inicializado com sucesso!")
@@ -86,8 +120,12 @@ def initialize_rag_async():
     t.start()
     return t
 
-# Dispara a inicialização em background
-initialize_rag_async()
+# Com Gunicorn em modo preload (RAG_SYNC_INIT), carrega antes do fork para que os
+# workers compartilhem os pesos via copy-on-write; caso contrário, em background
+if os.environ.get('RAG_SYNC_INIT', 'False').lower() == 'true':
+    initialize_rag()
+else:
+    initialize_rag_async()
 
 
 @app.route('/')
@@ -0,0 +1,44 @@
+import os
+import multiprocessing
+
+# Checagem de CUDA via NVML: não cria contexto CUDA no mestre antes do fork
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+import torch
+
+# CUDA não pode ser reinicializado em processos filhos de um fork: com GPU, cada worker
+# carrega seus próprios modelos (sem preload) e o padrão é um único worker dedicado à placa
+USE_GPU = torch.cuda.is_available()
+
+# Sem GPU, carrega o motor RAG no processo mestre antes do fork (ver app.py), de modo que
+# os pesos dos modelos fiquem uma única vez em memória compartilhada (copy-on-write).
+# Com preload a inicialização síncrona é obrigatória: uma thread de inicialização no mestre
+# não existiria nos workers, que ficariam sem motor RAG
+preload_app = not USE_GPU
+if preload_app:
+    os.environ["RAG_SYNC_INIT"] = "true"
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("GUNICORN_WORKERS", 1 if USE_GPU else max(1, multiprocessing.cpu_count() // 2)))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+
+
+def pre_fork(server, worker):
+    if not preload_app:
+        return
+    # O mestre só carrega os modelos; quem salva o cache de respostas são os workers
+    import app
+    if app.rag_engine is not None:
+        app.rag_engine.before_fork()
+
+
+def post_fork(server, worker):
+    # Divide os núcleos entre os workers: o pool intra-op do torch usa todos por padrão
+    torch.set_num_threads(max(1, multiprocessing.cpu_count() // server.cfg.workers))
+    if not preload_app:
+        return
+    # Threads (micro-batching) e locks não sobrevivem ao fork; recria no worker
+    import app
+    if app.rag_engine is not None:
+        app.rag_engine.after_fork()
@@ -1,17 +1,184 @@
 import os
-import glob
-import json
+import atexit
 import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
 from typing import List, Dict, Any
 from sentence_transformers import SentenceTransformer, CrossEncoder
-from transformers import pipeline
+from transformers import pipeline, AutoTokenizer
 import numpy as np
 import re
+import contextlib
+import torch
+
+try:
+    import faiss
+except ImportError:  # FAISS é opcional; sem ele a busca usa NumPy
+    faiss = None
+
+try:
+    import ahocorasick
+except ImportError:  # sem pyahocorasick, a seleção de sentenças usa regex
+    ahocorasick = None
+
+try:
+    from numba import njit
+except ImportError:  # Numba é opcional; sem ele a busca sem FAISS usa NumPy
+    njit = None
+
+# Quantidade máxima de perguntas com embedding mantido em memória (LRU)
+QUERY_CACHE_SIZE = 1024
+
+# Cache semântico de respostas: capacidade (buffer circular) e similaridade mínima para reuso
+ANSWER_CACHE_SIZE = 512
+ANSWER_CACHE_THRESHOLD = 0.95
+
+# Modelos de embeddings padrão por backend (EMBEDDINGS_BACKEND)
+DEFAULT_EMBEDDINGS_MODELS = {
+    "sentence-transformers": "sentence-transformers/all-mpnet-base-v2",
+    "fastembed": "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+    "itrex": "Intel/bge-small-en-v1.5-sts-int8-static-inc",
+}
+
+# Precisões suportadas para os modelos (MODEL_PRECISION)
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+# Sentenças escolhidas pelo reranker para compor a resposta
+ANSWER_SENTENCES = 3
+
+# Regexes usadas na montagem da resposta (compiladas uma vez)
+_WORD_RE = re.compile(r"\W+")
+_SENT_RE = re.compile(r"(?<=[.!?])\s+")
+_WS_RE = re.compile(r"\s+")
+
+# A partir deste tamanho de base, usa índice aproximado (HNSW) em vez de busca exata
+HNSW_MIN_CHUNKS = 100_000
+
+if njit is not None:
+    @njit(cache=True)
+    def _sift_down(scores, idx, k):
+        # Restaura o min-heap (raiz em 0) após substituir a raiz
+        pos = 0
+        while True:
+            child = 2 * pos + 1
+            if child >= k:
+                break
+            if child + 1 < k and scores[child + 1] < scores[child]:
+                child += 1
+            if scores[pos] <= scores[child]:
+                break
+            scores[pos], scores[child] = scores[child], scores[pos]
+            idx[pos], idx[child] = idx[child], idx[pos]
+            pos = child
+
+    # Serial de propósito: as camadas de threads do Numba (OpenMP/workqueue) não sobrevivem ao
+    # fork do Gunicorn com preload nem a chamadas concorrentes das threads do servidor
+    @njit(fastmath=True, cache=True)
+    def _topk_ip(emb, q, k):
+        """Produto interno + top-k em uma passada, mantendo um min-heap de k itens."""
+        n, d = emb.shape
+        scores = np.full(k, -np.inf, dtype=np.float32)
+        idx = np.full(k, -1, dtype=np.int64)
+        for i in range(n):
+            s = np.float32(0.0)
+            for j in range(d):
+                s += emb[i, j] * q[j]
+            if s > scores[0]:
+                scores[0] = s
+                idx[0] = i
+                _sift_down(scores, idx, k)
+        best = np.argsort(-scores)
+        return idx[best]
+
+
+def _token_matcher(tokens):
+    """Função que indica se um texto (minúsculo) contém algum dos tokens, em uma única passada."""
+    if not tokens:
+        return lambda text: False
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for tok in tokens:
+            automaton.add_word(tok, tok)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text), None) is not None
+    token_re = re.compile("|".join(map(re.escape, tokens)))
+    return lambda text: token_re.search(text) is not None
+
+
+class MicroBatcher:
+    """Agrupa itens enviados por requisições concorrentes em uma única chamada de `fn`.
+
+    Uma thread de fundo espera o primeiro item e coleta outros até `max_batch` itens
+    ou `max_wait_ms` milissegundos; `fn` recebe a lista e devolve um resultado por item.
+    """
+
+    def __init__(self, fn, max_batch: int = 32, max_wait_ms: float = 10):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            items = [item for item, _ in batch]
+            try:
+                results = list(self.fn(items))
+                if len(results) != len(batch):
+                    raise RuntimeError(f"MicroBatcher: {len(results)} resultados para {len(batch)} itens")
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+class ORTCrossEncoder:
+    """Reranker ONNX Runtime com a mesma interface de `CrossEncoder.predict`."""
+
+    def __init__(self, model, tokenizer, max_length: int = 512):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self._target_device = torch.device("cpu")
+
+    def predict(self, pairs, batch_size: int = 32, convert_to_tensor: bool = False, **kwargs):
+        scores = []
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            features = self.tokenizer([p[0] for p in batch], [p[1] for p in batch], padding=True, truncation="longest_first", max_length=self.max_length, return_tensors="pt")
+            logits = self.model(**features).logits
+            # Mesma ativação padrão do CrossEncoder: sigmoid para 1 rótulo
+            scores.append(torch.sigmoid(logits[:, 0]) if logits.shape[1] == 1 else logits)
+        scores = torch.cat(scores) if scores else torch.empty(0)
+        return scores if convert_to_tensor else scores.numpy()
+
 
 class RAGEngine:
-    def __init__(self, knowledge_base_dir: str = "knowledge_base", model_name: str = None, qa_model_name: str = None, chunk_chars: int = 700, chunk_overlap: int = 80, batch_size: int = 32, top_k: int = 5, reranker_model_name: str = None, pre_k: int = None, cache_dir: str = "cache"):
+    def __init__(self, knowledge_base_dir: str = "knowledge_base", model_name: str = None, qa_model_name: str = None, chunk_chars: int = 700, chunk_overlap: int = 80, batch_size: int = 32, top_k: int = 5, reranker_model_name: str = None, pre_k: int = None, cache_dir: str = "cache", quantize: bool = False, precision: str = "fp32", use_onnx: bool = False, onnx_provider: str = "CPUExecutionProvider", embeddings_backend: str = "sentence-transformers", microbatch_wait_ms: float = 10):
         self.knowledge_base_dir = knowledge_base_dir
-        self.model_name = model_name or 'sentence-transformers/all-mpnet-base-v2'
+        self.embeddings_backend = embeddings_backend if embeddings_backend in DEFAULT_EMBEDDINGS_MODELS else "sentence-transformers"
+        self.model_name = model_name or DEFAULT_EMBEDDINGS_MODELS[self.embeddings_backend]
         self.qa_model_name = qa_model_name or 'deepset/roberta-base-squad2'
         self.reranker_model_name = reranker_model_name or 'cross-encoder/ms-marco-MiniLM-L-6-v2'
         self.chunk_chars = chunk_chars
@@ -20,19 +187,40 @@ class RAGEngine:
         self.top_k = top_k
         self.pre_k = pre_k or max(top_k * 3, top_k)
         self.cache_dir = cache_dir
+        self.quantize = quantize  # índice int8 (FAISS ScalarQuantizer) no lugar de float32
+        self.precision = precision if precision in PRECISIONS else "fp32"
+        self.use_onnx = use_onnx  # QA e reranker via ONNX Runtime (optimum)
+        self.onnx_provider = onnx_provider
+        self.microbatch_wait_ms = microbatch_wait_ms  # 0 desativa o agrupamento de requisições concorrentes
 
         self.documents: List[Dict[str, str]] = []   # [{'title','content'}]
-        self.chunks: List[Dict[str, str]] = []      # [{'id','title','text'}]
+        # Chunks em estrutura de arrays: título via dicionário + textos UTF-8 contíguos com offsets
+        self.chunk_titles: List[str] = []
+        self.chunk_title_ids = np.empty(0, dtype=np.int32)
+        self.chunk_text_buf = b""
+        self.chunk_offsets = np.zeros(1, dtype=np.int64)  # len = num_chunks + 1
         self.embeddings = None
+        self.index = None
         self.model = None
         self.qa = None
         self.reranker = None
+        self._encode_q = None
+        self._rerank_q = None
         self._fingerprint = None
+        self._kb_entries = []                       # [(path, name, size, mtime)], de _scan_kb
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self.qcache_embs = None                     # (ANSWER_CACHE_SIZE, d), buffer circular
+        self.qcache_answers: List[Dict[str, str]] = []
+        self._qcache_next = 0
+        self._qcache_lock = threading.Lock()
+        self._persist_answers = True                # desligado no mestre do Gunicorn (ver before_fork)
         self.initialized = False
 
     def initialize(self):
         try:
             print("[RAG] Carregando documentos...")
+            self._scan_kb()
             self._load_documents()
             print("[RAG] Gerando chunks...")
             self._chunk_documents()
@@ -40,72 +228,272 @@ class RAGEngine:
             self._fingerprint = self._compute_fingerprint()
 
             print(f"[RAG] Carregando embeddings: {self.model_name}")
-            self.model = SentenceTransformer(self.model_name)
-            if not self._load_cache():
+            self._load_embedder()
+            from_cache = self._load_cache()
+            if not from_cache:
                 print("[RAG] Calculando embeddings dos chunks...")
-                texts = [c['text'] for c in self.chunks]
-                self.embeddings = self.model.encode(texts, show_progress_bar=True, batch_size=self.batch_size, normalize_embeddings=True)
-                print(f"[RAG] {len(self.chunks)} chunks indexados.")
+                texts = [self.chunk_text(i) for i in range(self.num_chunks)]
+                self.embeddings = self._embed_corpus(texts)
+                print(f"[RAG] {self.num_chunks} chunks indexados.")
                 self._save_cache()
             else:
-                print(f"[RAG] Embeddings carregados do cache ({len(self.chunks)} chunks).")
+                print(f"[RAG] Embeddings carregados do cache ({self.num_chunks} chunks).")
+            self._build_index(reuse_cached=from_cache)
+            self._prepare_exact_search()
+            self._load_answer_cache()
+            atexit.register(self._save_answer_cache)
             print(f"[RAG] Carregando QA: {self.qa_model_name}")
             try:
-                self.qa = pipeline("question-answering", model=self.qa_model_name)
+                self.qa = self._load_onnx_qa() if self.use_onnx else None
+                if self.qa is None:
+                    # Mesmo dispositivo que embeddings/reranker (sentence-transformers usa CUDA se houver)
+                    self.qa = pipeline("question-answering", model=self.qa_model_name, device=0 if torch.cuda.is_available() else -1)
+                # O pós-processamento do pipeline de QA usa NumPy, que não suporta bf16; só reduz em GPU
+                if isinstance(self.qa.model, torch.nn.Module) and self.qa.device.type == "cuda" and self.precision == "fp16":
+                    self.qa.model = self._apply_precision(self.qa.model, self.qa.device)
             except Exception as e:
                 print(f"[RAG] QA indisponível, usando fallback simples: {e}")
                 self.qa = None
             # Reranker
             try:
-                self.reranker = CrossEncoder(self.reranker_model_name)
+                self.reranker = self._load_onnx_reranker() if self.use_onnx else None
+                if self.reranker is None:
+                    self.reranker = CrossEncoder(self.reranker_model_name)
+                    self.reranker.model = self._apply_precision(self.reranker.model, self.reranker._target_device)
                 print(f"[RAG] Reranker carregado: {self.reranker_model_name}")
             except Exception as e:
                 print(f"[RAG] Reranker indisponível, seguindo sem reranqueamento: {e}")
                 self.reranker = None
+            self._start_batchers()
             self.initialized = True
             print("[RAG] Inicialização concluída.")
         except Exception as e:
             print(f"[RAG] Erro na inicialização: {e}")
             self.initialized = False
 
+    def _start_batchers(self):
+        self._encode_q = None
+        self._rerank_q = None
+        if self.microbatch_wait_ms <= 0:
+            return
+        self._encode_q = MicroBatcher(lambda qs: self._embed(qs, query=True), max_batch=self.batch_size, max_wait_ms=self.microbatch_wait_ms)
+        if self.reranker is not None:
+            self._rerank_q = MicroBatcher(self._predict_rerank, max_batch=self.batch_size * 4, max_wait_ms=self.microbatch_wait_ms)
+
+    def before_fork(self):
+        """No processo mestre: não serve perguntas, então não deve sobrescrever o cache dos workers ao sair."""
+        self._persist_answers = False
+
+    def after_fork(self):
+        """Recria locks e threads no processo filho (ex.: workers do Gunicorn com preload)."""
+        self._query_cache_lock = threading.Lock()
+        self._qcache_lock = threading.Lock()
+        self._persist_answers = True
+        if self.initialized:
+            self._start_batchers()
+
+    def _load_embedder(self):
+        if self.embeddings_backend != "sentence-transformers":
+            try:
+                if self.embeddings_backend == "fastembed":
+                    from fastembed import TextEmbedding
+                    self.model = TextEmbedding(model_name=self.model_name, cache_dir=os.path.join(self.cache_dir, "fastembed"))
+                else:
+                    # Modelo BGE quantizado em int8 (Intel Extension for Transformers)
+                    from langchain_community.embeddings import QuantizedBgeEmbeddings
+                    self.model = QuantizedBgeEmbeddings(model_name=self.model_name, query_instruction="", encode_kwargs={"normalize_embeddings": True, "batch_size": self.batch_size})
+                return
+            except Exception as e:
+                print(f"[RAG] Backend {self.embeddings_backend} indisponível, usando sentence-transformers: {e}")
+                self.embeddings_backend = "sentence-transformers"
+                self.model_name = DEFAULT_EMBEDDINGS_MODELS[self.embeddings_backend]
+                self._fingerprint = self._compute_fingerprint()
+        self.model = SentenceTransformer(self.model_name)
+        self.model[0].auto_model = self._apply_precision(self.model[0].auto_model, self.model.device)
+
+    def _load_onnx(self, ort_class, model_name: str):
+        """Carrega modelo ONNX do cache, exportando do Hugging Face na primeira execução."""
+        path = os.path.join(self.cache_dir, "onnx", model_name.replace("/", "__"))
+        if os.path.isdir(path):
+            model = ort_class.from_pretrained(path, provider=self.onnx_provider)
+            tokenizer = AutoTokenizer.from_pretrained(path)
+        else:
+            print(f"[RAG] Exportando {model_name} para ONNX...")
+            model = ort_class.from_pretrained(model_name, export=True, provider=self.onnx_provider)
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            model.save_pretrained(path)
+            tokenizer.save_pretrained(path)
+        return model, tokenizer
+
+    def _load_onnx_qa(self):
+        try:
+            from optimum.onnxruntime import ORTModelForQuestionAnswering
+            model, tokenizer = self._load_onnx(ORTModelForQuestionAnswering, self.qa_model_name)
+            print(f"[RAG] QA ONNX carregado ({self.onnx_provider}).")
+            return pipeline("question-answering", model=model, tokenizer=tokenizer)
+        except Exception as e:
+            print(f"[RAG] QA ONNX indisponível, usando PyTorch: {e}")
+            return None
+
+    def _load_onnx_reranker(self):
+        try:
+            from optimum.onnxruntime import ORTModelForSequenceClassification
+            model, tokenizer = self._load_onnx(ORTModelForSequenceClassification, self.reranker_model_name)
+            print(f"[RAG] Reranker ONNX carregado ({self.onnx_provider}).")
+            return ORTCrossEncoder(model, tokenizer)
+        except Exception as e:
+            print(f"[RAG] Reranker ONNX indisponível, usando PyTorch: {e}")
+            return None
+
+    def _apply_precision(self, module, device):
+        """Converte o modelo para bf16/fp16 conforme `precision` (IPEX em CPU, half em GPU)."""
+        dtype = PRECISIONS[self.precision]
+        if dtype is None:
+            return module
+        try:
+            if torch.device(device).type == "cuda":
+                module = module.to(dtype)
+                try:
+                    from optimum.bettertransformer import BetterTransformer
+                    module = BetterTransformer.transform(module)
+                except Exception:
+                    pass
+                return module
+            if dtype is torch.float16:
+                print("[RAG] fp16 não é eficiente em CPU; usando bf16.")
+                self.precision = "bf16"
+            try:
+                import intel_extension_for_pytorch as ipex
+                module = ipex.optimize(module.eval(), dtype=torch.bfloat16)
+            except ImportError:
+                pass  # sem IPEX o autocast em bf16 ainda usa os kernels oneDNN/AMX
+            return module
+        except Exception as e:
+            print(f"[RAG] Falha ao ajustar precisão ({self.precision}), mantendo fp32: {e}")
+            return module
+
+    def _autocast(self, device):
+        dtype = PRECISIONS[self.precision]
+        if dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+    def _embed(self, texts: List[str], query: bool = False, **kwargs) -> np.ndarray:
+        """Embeddings normalizados em float32, independente do backend e da precisão do modelo."""
+        if self.embeddings_backend == "fastembed":
+            # query_embed aplica o prefixo de consulta do modelo (ex.: "query: " no E5)
+            gen = self.model.query_embed(texts) if query else self.model.embed(texts, batch_size=self.batch_size)
+            emb = np.array(list(gen), dtype=np.float32)
+            return emb / np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+        if self.embeddings_backend == "itrex":
+            # Sem query_instruction, perguntas e documentos usam o mesmo encode: um único lote
+            return np.asarray(self.model.embed_documents(texts), dtype=np.float32)
+        with self._autocast(self.model.device):
+            emb = self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_tensor=True, **kwargs)
+        return emb.float().cpu().numpy()
+
+    @staticmethod
+    def _read_document(file_path: str):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read().strip()
+            if content:
+                return {"title": os.path.basename(file_path), "content": content}
+            print(f"⚠️ Documento vazio: {file_path}")
+        except Exception as e:
+            print(f"[RAG] Falha ao ler {file_path}: {e}")
+        return None
+
+    def _embed_corpus(self, texts: List[str]) -> np.ndarray:
+        """Embeddings dos chunks, codificados em ordem de tamanho para reduzir padding nos lotes."""
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        sorted_emb = self._embed_sorted_corpus([texts[i] for i in order])
+        emb = np.empty_like(sorted_emb)
+        emb[order] = sorted_emb
+        return emb
+
+    def _embed_sorted_corpus(self, texts: List[str]) -> np.ndarray:
+        # Com mais de uma GPU, distribui o lote entre elas
+        if self.embeddings_backend == "sentence-transformers" and torch.cuda.device_count() > 1:
+            try:
+                pool = self.model.start_multi_process_pool()
+                try:
+                    emb = self.model.encode_multi_process(texts, pool, batch_size=self.batch_size)
+                finally:
+                    self.model.stop_multi_process_pool(pool)
+                emb = np.asarray(emb, dtype=np.float32)
+                return emb / np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+            except Exception as e:
+                print(f"[RAG] Falha no encode multi-GPU, usando um único dispositivo: {e}")
+        return self._embed(texts, show_progress_bar=True)
+
+    def _scan_kb(self):
+        """Lista os .txt da base com tamanho e mtime em uma única passada (os.scandir)."""
+        entries = []
+        try:
+            with os.scandir(self.knowledge_base_dir) as it:
+                for e in it:
+                    if e.name.endswith('.txt') and not e.name.startswith('.') and e.is_file():
+                        st = e.stat()
+                        entries.append((e.path, e.name, st.st_size, int(st.st_mtime)))
+        except OSError as e:
+            print(f"[RAG] Falha ao listar {self.knowledge_base_dir}: {e}")
+        self._kb_entries = sorted(entries)
+
     def _load_documents(self):
-        self.documents = []
-        files = glob.glob(os.path.join(self.knowledge_base_dir, "*.txt"))
+        files = [path for path, _, _, _ in self._kb_entries]
         if not files:
             print("⚠️ Nenhum documento encontrado em", self.knowledge_base_dir)
-        for file_path in files:
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-                    title = os.path.basename(file_path)
-                    if content:
-                        self.documents.append({"title": title, "content": content})
-                    else:
-                        print(f"⚠️ Documento vazio: {file_path}")
-            except Exception as e:
-                print(f"[RAG] Falha ao ler {file_path}: {e}")
+        # Leitura em paralelo (I/O); map preserva a ordem dos arquivos
+        with ThreadPoolExecutor(max_workers=min(16, (os.cpu_count() or 1) * 2)) as ex:
+            self.documents = [doc for doc in ex.map(self._read_document, files) if doc is not None]
         print(f"[RAG] Documentos carregados: {len(self.documents)}")
 
     def _chunk_documents(self):
-        self.chunks = []
-        chunk_id = 0
+        titles: List[str] = []
+        title_ids: List[int] = []
+        texts: List[str] = []
         for doc in self.documents:
+            title_id = len(titles)
+            titles.append(doc['title'])
             paragraphs = [p.strip() for p in doc['content'].split('\n') if p.strip()]
             for para in paragraphs:
                 if len(para) <= self.chunk_chars:
-                    self.chunks.append({'id': chunk_id, 'title': doc['title'], 'text': para})
-                    chunk_id += 1
+                    texts.append(para)
+                    title_ids.append(title_id)
                 else:
                     start = 0
                     while start < len(para):
                         end = min(len(para), start + self.chunk_chars)
-                        text = para[start:end]
-                        self.chunks.append({'id': chunk_id, 'title': doc['title'], 'text': text})
-                        chunk_id += 1
+                        texts.append(para[start:end])
+                        title_ids.append(title_id)
                         if end == len(para):
                             break
                         start = max(0, end - self.chunk_overlap)
-        print(f"[RAG] Chunks gerados: {len(self.chunks)}")
+        self._set_chunks(titles, title_ids, texts)
+        print(f"[RAG] Chunks gerados: {self.num_chunks}")
+
+    def _set_chunks(self, titles: List[str], title_ids: List[int], texts: List[str]):
+        encoded = [t.encode('utf-8') for t in texts]
+        self.chunk_titles = list(titles)
+        self.chunk_title_ids = np.asarray(title_ids, dtype=np.int32)
+        self.chunk_text_buf = b"".join(encoded)
+        self.chunk_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=self.chunk_offsets[1:])
+
+    @property
+    def num_chunks(self) -> int:
+        return len(self.chunk_offsets) - 1
+
+    def chunk_text(self, i: int) -> str:
+        return self.chunk_text_buf[self.chunk_offsets[i]:self.chunk_offsets[i + 1]].decode('utf-8')
+
+    def chunk_title(self, i: int) -> str:
+        return self.chunk_titles[self.chunk_title_ids[i]]
+
+    def _chunk(self, i: int) -> Dict[str, Any]:
+        """Materializa um chunk como dict ({'id','title','text'}) para o pipeline de resposta."""
+        return {'id': int(i), 'title': self.chunk_title(i), 'text': self.chunk_text(i)}
 
     def _ensure_cache_dir(self):
         try:
@@ -116,122 +504,335 @@ class RAGEngine:
     def _compute_fingerprint(self) -> str:
         m = hashlib.sha256()
         m.update((self.model_name or '').encode('utf-8'))
+        m.update(self.embeddings_backend.encode('utf-8'))
         m.update(str(self.chunk_chars).encode('utf-8'))
         m.update(str(self.chunk_overlap).encode('utf-8'))
-        files = sorted(glob.glob(os.path.join(self.knowledge_base_dir, "*.txt")))
-        for fp in files:
-            try:
-                st = os.stat(fp)
-                m.update(os.path.basename(fp).encode('utf-8'))
-                m.update(str(st.st_size).encode('utf-8'))
-                m.update(str(int(st.st_mtime)).encode('utf-8'))
-            except Exception:
-                pass
+        for _, name, size, mtime in self._kb_entries:
+            m.update(name.encode('utf-8'))
+            m.update(str(size).encode('utf-8'))
+            m.update(str(mtime).encode('utf-8'))
         return m.hexdigest()[:16]
 
     def _cache_paths(self):
         emb_path = os.path.join(self.cache_dir, f"embeddings-{self._fingerprint}.npy")
-        chunks_path = os.path.join(self.cache_dir, f"chunks-{self._fingerprint}.json")
-        return emb_path, chunks_path
+        chunks_path = os.path.join(self.cache_dir, f"chunks-{self._fingerprint}.npz")
+        index_kind = "sq8" if self.quantize else "flat"
+        index_path = os.path.join(self.cache_dir, f"index-{self._fingerprint}-{index_kind}.faiss")
+        return emb_path, chunks_path, index_path
 
     def _load_cache(self) -> bool:
-        emb_path, chunks_path = self._cache_paths()
+        emb_path, chunks_path, _ = self._cache_paths()
         if os.path.exists(emb_path) and os.path.exists(chunks_path):
             try:
-                with open(chunks_path, 'r', encoding='utf-8') as f:
-                    cached_chunks = json.load(f)
-                if isinstance(cached_chunks, list) and len(cached_chunks) == len(self.chunks):
-                    self.chunks = cached_chunks
-                    self.embeddings = np.load(emb_path)
-                    return True
+                with np.load(chunks_path) as cached:
+                    offsets = cached['offsets']
+                    if len(offsets) - 1 != self.num_chunks:
+                        return False
+                    self.chunk_titles = [str(t) for t in cached['titles']]
+                    self.chunk_title_ids = cached['title_ids']
+                    self.chunk_text_buf = cached['text_buf'].tobytes()
+                    self.chunk_offsets = offsets
+                # Mapeado em memória: o SO carrega só as páginas usadas
+                self.embeddings = np.load(emb_path, mmap_mode='r')
+                return True
             except Exception as e:
                 print(f"[RAG] Falha ao carregar cache: {e}")
         return False
 
     def _save_cache(self):
-        emb_path, chunks_path = self._cache_paths()
+        emb_path, chunks_path, _ = self._cache_paths()
         try:
-            np.save(emb_path, self.embeddings)
-            with open(chunks_path, 'w', encoding='utf-8') as f:
-                json.dump(self.chunks, f, ensure_ascii=False)
+            np.save(emb_path, self.embeddings.astype(np.float16))
+            np.savez(
+                chunks_path,
+                titles=np.array(self.chunk_titles),
+                title_ids=self.chunk_title_ids,
+                text_buf=np.frombuffer(self.chunk_text_buf, dtype=np.uint8),
+                offsets=self.chunk_offsets,
+            )
         except Exception as e:
             print(f"[RAG] Falha ao salvar cache: {e}")
 
+    def _build_index(self, reuse_cached: bool = True):
+        """Monta (ou carrega do cache) o índice FAISS sobre os embeddings."""
+        self.index = None
+        if faiss is None or self.embeddings is None or len(self.embeddings) == 0:
+            if self.quantize and faiss is None:
+                print("[RAG] Quantização int8 requer FAISS; mantendo embeddings float32.")
+            return
+        _, _, index_path = self._cache_paths()
+        try:
+            if reuse_cached and os.path.exists(index_path):
+                index = faiss.read_index(index_path)
+                if index.ntotal == len(self.embeddings):
+                    self.index = index
+                    print(f"[RAG] Índice FAISS carregado do cache ({index.ntotal} vetores).")
+                    self._release_embeddings()
+                    return
+            emb = np.ascontiguousarray(self.embeddings, dtype='float32')
+            d = emb.shape[1]
+            hnsw = len(emb) >= HNSW_MIN_CHUNKS
+            if self.quantize:
+                qt = faiss.ScalarQuantizer.QT_8bit
+                if hnsw:
+                    index = faiss.IndexHNSWSQ(d, qt, 32, faiss.METRIC_INNER_PRODUCT)
+                else:
+                    index = faiss.IndexScalarQuantizer(d, qt, faiss.METRIC_INNER_PRODUCT)
+                index.train(emb)
+            elif hnsw:
+                index = faiss.IndexHNSWFlat(d, 32, faiss.METRIC_INNER_PRODUCT)
+            else:
+                index = faiss.IndexFlatIP(d)
+            index.add(emb)
+            self.index = index
+            faiss.write_index(index, index_path)
+            print(f"[RAG] Índice FAISS criado ({type(index).__name__}, {index.ntotal} vetores).")
+            self._release_embeddings()
+        except Exception as e:
+            print(f"[RAG] FAISS indisponível, usando busca NumPy: {e}")
+            self.index = None
+
+    def _prepare_exact_search(self):
+        # Sem índice FAISS as buscas percorrem a matriz inteira: o float16 do cache (sem BLAS
+        # no NumPy) seria ~15x mais lento, então converte uma única vez para float32
+        if self.index is None and self.embeddings is not None:
+            self.embeddings = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+            if njit is not None and len(self.embeddings):
+                # Compila o kernel agora (mesma assinatura da busca) para a primeira pergunta não pagar o JIT
+                _topk_ip(self.embeddings[:1], np.zeros(self.embeddings.shape[1], dtype=np.float32), 1)
+
+    def _release_embeddings(self):
+        # Com índice int8 a matriz float32 não é mais consultada; libera ~4x de memória
+        if self.quantize and self.index is not None:
+            self.embeddings = None
+
+    def _search(self, query_embedding, k: int):
+        """Retorna os índices dos k chunks mais similares, do mais ao menos similar."""
+        if self.index is not None:
+            if hasattr(self.index, 'hnsw'):
+                self.index.hnsw.efSearch = max(k * 2, 64)
+            _, I = self.index.search(np.ascontiguousarray(query_embedding.reshape(1, -1), dtype='float32'), k)
+            return [int(i) for i in I[0] if i >= 0]
+        if njit is not None:
+            return [int(i) for i in _topk_ip(self.embeddings, query_embedding.astype(np.float32), k) if i >= 0]
+        sims = np.dot(self.embeddings, query_embedding)  # embeddings normalizados → cosseno
+        # argpartition seleciona os k maiores sem ordenar a base inteira
+        top = np.argpartition(sims, len(sims) - k)[-k:]
+        return top[np.argsort(sims[top])[::-1]]
+
+    def _encode_query(self, question: str) -> np.ndarray:
+        """Embedding da pergunta, reaproveitando perguntas repetidas via LRU."""
+        # Só a chave do cache ignora maiúsculas; o modelo recebe a pergunta como escrita
+        text = " ".join(question.split())
+        key = text.lower()
+        with self._query_cache_lock:
+            cached = self._query_cache.get(key)
+            if cached is not None:
+                self._query_cache.move_to_end(key)
+                return cached
+        if self._encode_q is not None:
+            embedding = self._encode_q.submit(text).result()
+        else:
+            embedding = self._embed([text], query=True)[0]
+        with self._query_cache_lock:
+            self._query_cache[key] = embedding
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return embedding
+
     def query(self, question: str) -> Dict[str, Any]:
         if not self.initialized:
             return {"answer": "Sistema RAG não inicializado.", "source": "Sistema"}
 
         try:
-            if not self.chunks:
+            if self.num_chunks == 0:
                 return {"answer": "Nenhum conteúdo disponível na base.", "source": "Sistema"}
 
-            query_embedding = self.model.encode([question], normalize_embeddings=True)[0]
-            sims = np.dot(self.embeddings, query_embedding)  # embeddings normalizados → cosseno
-            pre_k = min(len(self.chunks), self.pre_k)
-            pre_indices = np.argsort(sims)[-pre_k:][::-1]
-            pre_chunks = [self.chunks[i] for i in pre_indices]
-
-            if self.reranker is not None:
-                try:
-                    pairs = [(question, c['text']) for c in pre_chunks]
-                    scores = self.reranker.predict(pairs)
-                    ranked = sorted(zip(pre_chunks, scores), key=lambda x: x[1], reverse=True)
-                    top_chunks = [c for c, _ in ranked[:self.top_k]]
-                except Exception as e:
-                    print(f"[RAG] Falha no reranqueamento: {e}")
-                    top_chunks = pre_chunks[:self.top_k]
-            else:
-                top_chunks = pre_chunks[:self.top_k]
-            context = "\n\n".join([c['text'] for c in top_chunks])
-            sources = [c['title'] for c in top_chunks]
-
-            # Tenta responder com QA para foco
-            if self.qa is not None:
-                try:
-                    qa_out = self.qa(question=question, context=context)
-                    answer = qa_out.get('answer', '').strip()
-                    score = qa_out.get('score', 0.0)
-                    if answer and score >= 0.15:
-                        # Se a resposta for muito curta, enriquecemos com trechos relevantes
-                        if len(answer) < 40:
-                            enriched = self._build_answer(question, top_chunks, base_answer=answer)
-                            return {"answer": enriched, "source": ", ".join(dict.fromkeys(sources))}
-                        return {"answer": answer, "source": ", ".join(dict.fromkeys(sources))}
-                except Exception as e:
-                    print(f"[RAG] Falha no QA: {e}")
-
-            # Fallback: devolve melhores trechos com fonte
-            answer = self._build_answer(question, top_chunks)
-            return {"answer": answer, "source": ", ".join(dict.fromkeys(sources))}
+            query_embedding = self._encode_query(question)
+            cached = self._lookup_answer(query_embedding)
+            if cached is not None:
+                return cached
+            result, complete = self._answer(question, query_embedding)
+            # Respostas degradadas (falha no reranker ou no QA) não entram no cache
+            if complete:
+                self._remember_answer(query_embedding, result)
+            return result
 
         except Exception as e:
             import traceback
             traceback.print_exc()
             return {"answer": f"Erro ao processar: {e}", "source": "Sistema"}
 
-    def _build_answer(self, question: str, top_chunks: List[Dict[str, str]], base_answer: str = "") -> str:
-        # Palavras da pergunta para seleção de sentenças
-        q = question.lower()
-        tokens = [t for t in re.split(r"\W+", q) if len(t) > 2]
-        selected_sentences = []
-        for c in top_chunks:
-            sentences = re.split(r"(?<=[.!?])\s+", c['text'])
-            for s in sentences:
-                s_clean = s.strip()
-                if not s_clean:
-                    continue
-                if any(tok in s_clean.lower() for tok in tokens):
-                    selected_sentences.append(s_clean)
+    def _answer(self, question: str, query_embedding: np.ndarray):
+        """Executa o pipeline completo; retorna (resposta, se nenhuma etapa falhou)."""
+        complete = True
+        pre_k = min(self.num_chunks, self.pre_k)
+        pre_indices = self._search(query_embedding, pre_k)
+        pre_chunks = [self._chunk(i) for i in pre_indices]
+
+        if self.reranker is not None:
+            try:
+                pairs = [(question, c['text']) for c in pre_chunks]
+                scores = self._rerank_scores(pairs)
+                ranked = sorted(zip(pre_chunks, scores), key=lambda x: x[1], reverse=True)
+                top_chunks = [c for c, _ in ranked[:self.top_k]]
+            except Exception as e:
+                print(f"[RAG] Falha no reranqueamento: {e}")
+                top_chunks = pre_chunks[:self.top_k]
+                complete = False
+        else:
+            top_chunks = pre_chunks[:self.top_k]
+        context = "\n\n".join([c['text'] for c in top_chunks])
+        sources = [c['title'] for c in top_chunks]
+
+        # Tenta responder com QA para foco
+        if self.qa is not None:
+            try:
+                qa_out = self.qa(question=question, context=context)
+                answer = qa_out.get('answer', '').strip()
+                score = qa_out.get('score', 0.0)
+                if answer and score >= 0.15:
+                    # Se a resposta for muito curta, enriquecemos com trechos relevantes
+                    if len(answer) < 40:
+                        enriched, ranked_ok = self._build_answer(question, top_chunks, base_answer=answer)
+                        complete = complete and ranked_ok
+                        return {"answer": enriched, "source": ", ".join(dict.fromkeys(sources))}, complete
+                    return {"answer": answer, "source": ", ".join(dict.fromkeys(sources))}, complete
+            except Exception as e:
+                print(f"[RAG] Falha no QA: {e}")
+                complete = False
+
+        # Fallback: devolve melhores trechos com fonte
+        answer, ranked_ok = self._build_answer(question, top_chunks)
+        complete = complete and ranked_ok
+        return {"answer": answer, "source": ", ".join(dict.fromkeys(sources))}, complete
+
+    def _rerank_scores(self, pairs: List[tuple]) -> np.ndarray:
+        if self._rerank_q is not None:
+            futures = [self._rerank_q.submit(p) for p in pairs]
+            return np.array([f.result() for f in futures], dtype=np.float32)
+        return self._predict_rerank(pairs)
+
+    def _predict_rerank(self, pairs: List[tuple]) -> np.ndarray:
+        """Scores do CrossEncoder, agrupando pares de tamanho parecido para reduzir padding."""
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+        ctx = contextlib.nullcontext() if isinstance(self.reranker, ORTCrossEncoder) else self._autocast(self.reranker._target_device)
+        with ctx:
+            sorted_scores = self.reranker.predict([pairs[i] for i in order], batch_size=self.batch_size, convert_to_tensor=True)
+        scores = np.empty(len(pairs), dtype=np.float32)
+        scores[order] = sorted_scores.float().cpu().numpy()
+        return scores
+
+    def _answer_cache_path(self) -> str:
+        # Além da base/embeddings, as respostas dependem dos modelos de QA/reranker, de top_k/pre_k,
+        # do tipo de índice (flat/sq8) e do runtime/precisão dos modelos
+        m = hashlib.sha256()
+        for part in (self.qa_model_name, self.reranker_model_name, self.top_k, self.pre_k,
+                     self.quantize, self.use_onnx, self.precision):
+            m.update(str(part).encode('utf-8'))
+        return os.path.join(self.cache_dir, f"qcache-{self._fingerprint}-{m.hexdigest()[:8]}.npz")
+
+    def _lookup_answer(self, query_embedding: np.ndarray):
+        """Resposta já dada a uma pergunta semanticamente equivalente, se houver."""
+        with self._qcache_lock:
+            if not self.qcache_answers:
+                return None
+            sims = self.qcache_embs[:len(self.qcache_answers)] @ query_embedding
+            best = int(np.argmax(sims))
+            if sims[best] >= ANSWER_CACHE_THRESHOLD:
+                return dict(self.qcache_answers[best])
+        return None
+
+    def _remember_answer(self, query_embedding: np.ndarray, result: Dict[str, str]):
+        with self._qcache_lock:
+            if self.qcache_embs is None:
+                self.qcache_embs = np.zeros((ANSWER_CACHE_SIZE, len(query_embedding)), dtype=np.float32)
+            pos = self._qcache_next
+            self.qcache_embs[pos] = query_embedding
+            if pos < len(self.qcache_answers):
+                self.qcache_answers[pos] = dict(result)
+            else:
+                self.qcache_answers.append(dict(result))
+            self._qcache_next = (pos + 1) % ANSWER_CACHE_SIZE
+
+    def _load_answer_cache(self):
+        path = self._answer_cache_path()
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path) as data:
+                embs, answers, sources = data['embs'], data['answers'], data['sources']
+            n = min(len(answers), ANSWER_CACHE_SIZE)
+            with self._qcache_lock:
+                self.qcache_embs = np.zeros((ANSWER_CACHE_SIZE, embs.shape[1]), dtype=np.float32)
+                self.qcache_embs[:n] = embs[:n]
+                self.qcache_answers = [{"answer": str(a), "source": str(s)} for a, s in zip(answers[:n], sources[:n])]
+                self._qcache_next = n % ANSWER_CACHE_SIZE
+            print(f"[RAG] Cache de respostas carregado ({n} entradas).")
+        except Exception as e:
+            print(f"[RAG] Falha ao carregar cache de respostas: {e}")
+
+    def _save_answer_cache(self):
+        if not self._persist_answers:
+            return
+        with self._qcache_lock:
+            if not self.qcache_answers:
+                return
+            n = len(self.qcache_answers)
+            embs = self.qcache_embs[:n].copy()
+            answers = np.array([r['answer'] for r in self.qcache_answers])
+            sources = np.array([r['source'] for r in self.qcache_answers])
+        path = self._answer_cache_path()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            # Escrita atômica: vários workers podem salvar ao mesmo tempo no encerramento
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, embs=embs, answers=answers, sources=sources)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"[RAG] Falha ao salvar cache de respostas: {e}")
+
+    def _rank_sentences(self, question: str, sentences: List[str]):
+        """Melhores sentenças segundo o reranker (em uma chamada), na ordem original; None sem reranker."""
+        if self.reranker is None or not sentences:
+            return None
+        scores = self._rerank_scores([(question, s) for s in sentences])
+        best = np.sort(np.argsort(scores)[::-1][:ANSWER_SENTENCES])
+        return [sentences[i] for i in best]
+
+    def _select_sentences(self, question: str, top_chunks: List[Dict[str, str]]):
+        """Retorna (sentenças, se o reranker não falhou); sem reranker usa palavras-chave."""
+        sentences = [s.strip() for c in top_chunks for s in _SENT_RE.split(c['text']) if s.strip()]
+        ranked_ok = True
+        try:
+            selected_sentences = self._rank_sentences(question, sentences)
+        except Exception as e:
+            print(f"[RAG] Falha ao ranquear sentenças: {e}")
+            selected_sentences = None
+            ranked_ok = False
+        if selected_sentences is None:
+            # Sem reranker: palavras da pergunta para seleção de sentenças
+            q = question.lower()
+            tokens = frozenset(t for t in _WORD_RE.split(q) if len(t) > 2)
+            has_token = _token_matcher(tokens)
+            selected_sentences = [s for s in sentences if has_token(s.lower())]
+        return selected_sentences, ranked_ok
+
+    def _build_answer(self, question: str, top_chunks: List[Dict[str, str]], base_answer: str = ""):
+        """Retorna (texto da resposta, se a seleção de sentenças pelo reranker não falhou)."""
+        # Seleção de sentenças só quando a resposta precisa delas (QA ausente, fraco ou curto)
+        selected_sentences, ranked_ok = self._select_sentences(question, top_chunks)
         # Usa sentenças selecionadas ou os primeiros trechos
         if not selected_sentences:
             selected_sentences = [c['text'].strip() for c in top_chunks[:2] if c['text'].strip()]
         # Limita tamanho e remove quebras excessivas
         summary = " ".join(selected_sentences)
-        summary = re.sub(r"\s+", " ", summary).strip()
+        summary = _WS_RE.sub(" ", summary).strip()
         if len(summary) > 800:
             summary = summary[:800].rsplit(" ", 1)[0]
         if base_answer:
             intro = f"{base_answer}. " if base_answer.endswith('.') else f"{base_answer}: "
         else:
             intro = "De acordo com o Programa Farmácia Popular, "
-        return f"{intro}{summary}"
\ No newline at end of file
+        return f"{intro}{summary}", ranked_ok
\ No newline at end of file